@@ -103,6 +103,7 @@ class PokeData(Dataset):
         self.test_path = os.path.join(data_path, "processed")
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.input_shape: tuple[int, ...] | None = None  # Shape of a single image [C, H, W], set by the train loader
 
     def __len__(self) -> int:
         """Return the length of the dataset."""
@@ -130,9 +131,19 @@ class PokeData(Dataset):
         train: torch.Tensor = torch.load(os.path.join(self.train_path, "train.pt"), weights_only=True)
         train_img = train["images"]
         train_labels = train["labels"]
+        self.input_shape = tuple(train_img.shape[1:])
         train_dataset = TensorDataset(train_img, train_labels)
+        # Drop the last partial batch so every training step sees the same input shape.
+        # Keep workers alive across epochs, since the train loader is iterated once per epoch.
         return DataLoader(
-            train_dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers, pin_memory=True
+            train_dataset,
+            batch_size=self.batch_size,
+            shuffle=True,
+            num_workers=self.num_workers,
+            pin_memory=True,
+            persistent_workers=self.num_workers > 0,
+            prefetch_factor=2 if self.num_workers > 0 else None,
+            drop_last=True,
         )
 
     def _get_val_loader(self) -> DataLoader:
@@ -141,8 +152,15 @@ class PokeData(Dataset):
         val_img = val["images"]
         val_labels = val["labels"]
         val_dataset = TensorDataset(val_img, val_labels)
+        # Keep workers alive across epochs, since the val loader is iterated once per epoch
         return DataLoader(
-            val_dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers, pin_memory=True
+            val_dataset,
+            batch_size=self.batch_size,
+            shuffle=True,
+            num_workers=self.num_workers,
+            pin_memory=True,
+            persistent_workers=self.num_workers > 0,
+            prefetch_factor=2 if self.num_workers > 0 else None,
         )
 
     def _get_test_loader(self) -> DataLoader:
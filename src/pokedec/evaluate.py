@@ -67,7 +67,7 @@ def evaluate(model_version: int):
     # Evaluation loop
     print("Evaluating model...")
     with torch.no_grad():
-        for inputs, labels in tqdm(test_loader):
+        for inputs, labels in tqdm(test_loader, mininterval=1.0, miniters=50):
             inputs, labels = inputs.to(device), labels.to(device)
             outputs = model(inputs)
             loss = criterion(outputs, labels)
@@ -1,5 +1,9 @@
+import copy
 import logging
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
 import torch
 import torch.nn as nn
@@ -8,7 +12,7 @@ import typer
 import wandb
 from data import PokeData
 from model import get_model
-from torch.profiler import ProfilerActivity, profile, record_function, tensorboard_trace_handler
+from torch.profiler import ProfilerActivity, profile, record_function, schedule, tensorboard_trace_handler
 from tqdm import tqdm
 
 # Create the training_logs directory if it doesn't exist
@@ -32,6 +36,35 @@ logger = logging.getLogger(__name__)
 # Set the device to GPU if available, otherwise use mps or CPU
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu")
 
+# Allow TF32 tensor cores for FP32 matmuls and convolutions (also speeds up torch.compile warm-up)
+torch.set_float32_matmul_precision("high")
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
+# Let cuDNN autotune convolution algorithms; input shapes are fixed since the train loader drops the last batch
+torch.backends.cudnn.benchmark = True
+
+
+def export_onnx(model: nn.Module, input_shape: tuple[int, ...], path: str) -> None:
+    """
+    Exports a model to ONNX format.
+
+    Args:
+        model (nn.Module): The model to export. It should be on the CPU and in eval mode.
+        input_shape (tuple): The shape of a single input image, [C, H, W].
+        path (str): The path to save the ONNX model to.
+    """
+    # Tracing only needs the input shape, so export with a dummy image instead of loading a val batch
+    img = torch.zeros(1, *input_shape)
+    torch.onnx.export(
+        model,
+        img,
+        path,
+        input_names=["input"],
+        output_names=["output"],
+        opset_version=17,
+    )
+
 
 def train_model(
     num_classes: int = 1000,
@@ -43,6 +76,9 @@ def train_model(
     profiling: bool = False,
     export_model: bool = True,
     sweep: bool = True,
+    num_workers: int = 1,
+    accum_steps: int = 1,
+    cuda_graphs: bool = False,
 ) -> None:
     """
     Trains a model to classify Pokemon using the specified hyperparameters.
@@ -51,16 +87,29 @@ def train_model(
         num_classes (int): The number of output classes for the classifier.
         batch_size (int): The number of samples in each batch.
         num_epochs (int): The number of epochs to train the model.
-        lr (float): The learning rate for the optimizer.
+        lr (float): The base learning rate of the one-cycle schedule. Training starts at 0.4 * lr, peaks at 10 * lr
+            and then anneals towards zero (all scaled by accum_steps).
         wd (float): The weight decay for the optimizer.
         use_wandb (bool): Whether to use Weights & Biases for logging.
         profiling (bool): Whether to enable profiling during training.
         export_model (bool): Whether to export the model to ONNX format after training.
         sweep (bool): Whether to run the training as part of a sweep.
+        num_workers (int): The number of worker processes used by the data loaders.
+        accum_steps (int): The number of batches to accumulate gradients over before each optimizer step.
+            The learning rate is scaled linearly with the resulting effective batch size.
+        cuda_graphs (bool): Whether to replay the compiled forward and backward passes as CUDA graphs.
+            Requires a CUDA device and cannot be combined with accum_steps > 1.
 
     Returns:
         None: The function performs training, validation, and artifact logging but does not return any value.
     """
+    if accum_steps < 1:
+        raise typer.BadParameter(f"accum_steps must be at least 1, got {accum_steps}")
+    if cuda_graphs and DEVICE.type != "cuda":
+        raise typer.BadParameter(f"cuda_graphs requires a CUDA device, got {DEVICE.type}")
+    if cuda_graphs and accum_steps > 1:
+        # CUDA graph replays reuse the memory holding the gradients, so they cannot be accumulated across steps
+        raise typer.BadParameter("cuda_graphs does not support gradient accumulation, use accum_steps=1")
 
     # Initialize Weights & Biases
     if use_wandb:
@@ -91,129 +140,180 @@ def train_model(
         setup_logging("dummy_run")
 
     logger.info(
-        f"Training model with the following config: lr={lr}, batch_size={batch_size}, num_epochs={num_epochs}, wd={wd}, num_classes={num_classes}, use_wandb={use_wandb}, profiling={profiling}, export_model={export_model}, sweep={sweep}"
+        f"Training model with the following config: lr={lr}, batch_size={batch_size}, num_epochs={num_epochs}, wd={wd}, num_classes={num_classes}, use_wandb={use_wandb}, profiling={profiling}, export_model={export_model}, sweep={sweep}, num_workers={num_workers}, accum_steps={accum_steps}, cuda_graphs={cuda_graphs}"
     )
 
     # Load model
     model = get_model(num_classes=num_classes)
     logger.info(f"Using device: {DEVICE}")
-    model = model.to(DEVICE)
+    # channels_last (NHWC) lets cuDNN pick its tensor-core convolution kernels
+    model = model.to(DEVICE, memory_format=torch.channels_last)
+    compile_mode = None
+    if DEVICE.type == "cuda":
+        # Fuse forward/backward kernels; static shapes are guaranteed by drop_last on the train loader.
+        # "reduce-overhead" additionally captures the compiled kernels in CUDA graphs and replays them each step.
+        compile_mode = "reduce-overhead" if cuda_graphs else "default"
+        model = torch.compile(model, mode=compile_mode, dynamic=False)
+    # Uncompiled module, used for saving the state dict and ONNX export
+    base_model = getattr(model, "_orig_mod", model)
 
     # Load data
-    poke_data = PokeData(data_path="data", batch_size=batch_size, num_workers=1)
+    poke_data = PokeData(data_path="data", batch_size=batch_size, num_workers=num_workers)
     train_loader = poke_data._get_train_loader()
     val_loader = poke_data._get_val_loader()
 
+    # Scale the learning rate linearly with the effective batch size
+    lr = lr * accum_steps
+    max_lr = lr * 10
+    logger.info(f"Effective batch size: {batch_size * accum_steps}")
+    logger.info(f"One-cycle learning rate: initial {max_lr / 25}, peak {max_lr}")
+
     # Define loss and optimizer
     criterion = nn.CrossEntropyLoss()
-    optimizer = optim.AdamW(model.parameters(), lr=lr, weight_decay=wd)
+    # The fused implementation updates all parameters in a single CUDA kernel
+    optimizer = optim.AdamW(model.parameters(), lr=lr, weight_decay=wd, fused=DEVICE.type == "cuda")
+
+    # One-cycle learning rate schedule, stepped after every optimizer step
+    steps_per_epoch = math.ceil(len(train_loader) / accum_steps)
+    # First step of the last accumulation group, which is smaller when accum_steps does not divide the epoch
+    last_group_start = len(train_loader) - len(train_loader) % accum_steps
+    scheduler = optim.lr_scheduler.OneCycleLR(optimizer, max_lr=max_lr, total_steps=num_epochs * steps_per_epoch)
+
+    # Mixed precision: autocast the forward pass to FP16 and scale the loss to avoid gradient underflow (CUDA only)
+    use_amp = DEVICE.type == "cuda"
+    scaler = torch.amp.GradScaler("cuda", enabled=use_amp)
+
+    # Number of samples seen per epoch (the train loader drops its last partial batch)
+    n_train = len(train_loader) * train_loader.batch_size
+    n_val = len(val_loader.dataset)
+    logger.info(f"Training samples per epoch: {n_train}, validation samples: {n_val}")
+
+    # Persistent device buffers for training batches. The pinned batch is NCHW, so it is copied into a staging
+    # buffer of the same layout (a plain async memcpy) and then converted into the channels_last input buffer
+    # on the device, without any per-step allocation.
+    batch_shape = (train_loader.batch_size, *poke_data.input_shape)
+    staging_inputs = torch.empty(batch_shape, device=DEVICE)
+    device_inputs = torch.empty(batch_shape, device=DEVICE, memory_format=torch.channels_last)
+    device_labels = torch.empty(train_loader.batch_size, dtype=torch.long, device=DEVICE)
+
+    def region(name: str):
+        """Label a region of the profiler trace, a no-op when not profiling."""
+        return record_function(name) if profiling else nullcontext()
+
+    def train_step(step: int, inputs: torch.Tensor, labels: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """Run one training batch and return its summed loss and number of correct predictions."""
+        if compile_mode == "reduce-overhead":
+            # Tell the CUDA graph trees that outputs of the previous step are no longer in use
+            torch.compiler.cudagraph_mark_step_begin()
+        staging_inputs.copy_(inputs, non_blocking=True)
+        inputs = device_inputs.copy_(staging_inputs)
+        labels = device_labels.copy_(labels, non_blocking=True)
+
+        # Forward pass
+        with torch.autocast(device_type=DEVICE.type, dtype=torch.float16, enabled=use_amp):
+            with region("model_forward"):
+                outputs = model(inputs)
+            with region("loss_computation"):
+                loss = criterion(outputs, labels)
 
-    # Learning rate scheduler (optional)
-    scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=5, gamma=0.1)
+        # Backward pass, averaging gradients over the batches of the accumulation group
+        group_size = accum_steps if step < last_group_start else len(train_loader) - last_group_start
+        with region("backward_pass"):
+            scaler.scale(loss / group_size).backward()
+        if (step + 1) % accum_steps == 0 or step + 1 == len(train_loader):
+            with region("optimizer_step"):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+                scheduler.step()
+
+        return loss.detach() * inputs.size(0), (outputs.argmax(dim=1) == labels).sum()
+
+    # Only profile a handful of steps to keep the trace small
+    profiler = (
+        profile(
+            activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
+            schedule=schedule(wait=1, warmup=1, active=3, repeat=1),
+            record_shapes=True,
+            with_stack=True,
+            on_trace_ready=tensorboard_trace_handler("models/profiler"),
+        )
+        if profiling
+        else nullcontext()
+    )
 
     # Training loop
-    for epoch in tqdm(range(num_epochs)):
-        logger.info(f"Epoch {epoch+1}/{num_epochs}")
-
-        # Training phase
-        model.train()
-        running_loss = 0.0
-        correct = 0
-        total = 0
-
-        if profiling:
-            # Profiling context manager
-            with profile(
-                activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
-                record_shapes=True,
-                with_stack=True,
-                on_trace_ready=tensorboard_trace_handler("models/profiler"),
-            ) as prof:
-                for inputs, labels in train_loader:
-                    inputs, labels = inputs.to(DEVICE), labels.to(DEVICE)
-                    optimizer.zero_grad()
-
-                    # Forward pass
-                    with record_function("model_forward"):
-                        outputs = model(inputs)
-                    with record_function("loss_computation"):
-                        loss = criterion(outputs, labels)
-                    with record_function("backward_pass"):
-                        loss.backward()
-                    with record_function("optimizer_step"):
-                        optimizer.step()
-
+    with profiler as prof:
+        for epoch in tqdm(range(num_epochs)):
+            logger.info(f"Epoch {epoch+1}/{num_epochs}")
+
+            # Training phase
+            model.train()
+            # Accumulate statistics on the device and only sync once per epoch
+            running_loss = torch.zeros((), device=DEVICE)
+            correct = torch.zeros((), dtype=torch.long, device=DEVICE)
+            optimizer.zero_grad(set_to_none=True)
+
+            for step, (inputs, labels) in enumerate(train_loader):
+                batch_loss, batch_correct = train_step(step, inputs, labels)
+                if profiling:
                     prof.step()
 
-                    # Statistics
-                    running_loss += loss.item() * inputs.size(0)
-                    _, predicted = outputs.max(1)
-                    total += labels.size(0)
-                    correct += predicted.eq(labels).sum().item()
-
-        else:
-            for inputs, labels in train_loader:
-                inputs, labels = inputs.to(DEVICE), labels.to(DEVICE)
-                optimizer.zero_grad()
-
-                # Forward pass
-                outputs = model(inputs)
-                loss = criterion(outputs, labels)
-
-                # Backward pass
-                loss.backward()
-                optimizer.step()
-
                 # Statistics
-                running_loss += loss.item() * inputs.size(0)
-                _, predicted = outputs.max(1)
-                total += labels.size(0)
-                correct += predicted.eq(labels).sum().item()
-
-        # Log epoch statistics
-        epoch_loss = running_loss / len(train_loader.dataset)
-        epoch_acc = correct / total
-        logger.info(f"Train Loss: {epoch_loss:.4f}, Train Acc: {epoch_acc:.4f}")
-
-        # Validation phase
-        model.eval()
-        val_loss = 0.0
-        val_correct = 0
-        val_total = 0
-        with torch.no_grad():
-            for inputs, labels in val_loader:
-                inputs, labels = inputs.to(DEVICE), labels.to(DEVICE)
-                outputs = model(inputs)
-                loss = criterion(outputs, labels)
+                running_loss += batch_loss
+                correct += batch_correct
+
+            # Validation phase. With CUDA graphs, run it on the uncompiled model so eval mode and the smaller
+            # last batch do not record an extra set of graphs
+            val_model = base_model if compile_mode == "reduce-overhead" else model
+            val_model.eval()
+            val_loss = torch.zeros((), device=DEVICE)
+            val_correct = torch.zeros((), dtype=torch.long, device=DEVICE)
+            with torch.inference_mode():
+                for inputs, labels in val_loader:
+                    inputs = inputs.to(DEVICE, non_blocking=True, memory_format=torch.channels_last)
+                    labels = labels.to(DEVICE, non_blocking=True)
+                    with torch.autocast(device_type=DEVICE.type, dtype=torch.float16, enabled=use_amp):
+                        outputs = val_model(inputs)
+                        loss = criterion(outputs, labels)
 
-                val_loss += loss.item() * inputs.size(0)
-                _, predicted = outputs.max(1)
-                val_total += labels.size(0)
-                val_correct += predicted.eq(labels).sum().item()
+                    val_loss += loss.detach() * inputs.size(0)
+                    val_correct += (outputs.argmax(dim=1) == labels).sum()
 
-        val_loss /= len(val_loader.dataset)
-        val_acc = val_correct / val_total
-        logger.info(f"Val Loss: {val_loss:.4f}, Val Acc: {val_acc:.4f}")
+            # Log epoch statistics, copying all device-side metrics to the host in a single sync
+            metrics = {
+                "train_loss": running_loss / n_train,
+                "train_accuracy": correct / n_train,
+                "val_loss": val_loss / n_val,
+                "val_accuracy": val_correct / n_val,
+            }
+            metrics = dict(zip(metrics.keys(), torch.stack(list(metrics.values())).tolist()))
+            logger.info(f"Train Loss: {metrics['train_loss']:.4f}, Train Acc: {metrics['train_accuracy']:.4f}")
+            logger.info(f"Val Loss: {metrics['val_loss']:.4f}, Val Acc: {metrics['val_accuracy']:.4f}")
 
-        if use_wandb:
-            wandb.log(
-                {"train_loss": epoch_loss, "train_accuracy": epoch_acc, "val_loss": val_loss, "val_accuracy": val_acc}
-            )
-
-        # Step the scheduler
-        scheduler.step()
+            if use_wandb:
+                wandb.log(metrics)
 
     logger.info("Finished Training")
 
+    # Export model to ONNX format in the background while the checkpoint is saved and uploaded
+    if export_model and use_wandb:
+        onnx_path = f"models/onnx/pokedec_model_{run.id}.onnx"
+        os.makedirs("models/onnx", exist_ok=True)
+        model_cpu = copy.deepcopy(base_model).to("cpu", memory_format=torch.contiguous_format).eval()
+        executor = ThreadPoolExecutor(max_workers=1)
+        onnx_export = executor.submit(export_onnx, model_cpu, poke_data.input_shape, onnx_path)
+        executor.shutdown(wait=False)
+
     # Save the model
     if use_wandb:
         if sweep:
             os.makedirs("models/sweep", exist_ok=True)
-            torch.save(model.state_dict(), f"models/sweep/pokedec_model_{run.id}.pth")
+            torch.save(base_model.state_dict(), f"models/sweep/pokedec_model_{run.id}.pth")
         else:
             # Single model
             os.makedirs("models/single", exist_ok=True)
-            torch.save(model.state_dict(), f"models/single/pokedec_model_{run.id}.pth")
+            torch.save(base_model.state_dict(), f"models/single/pokedec_model_{run.id}.pth")
 
         artifact = wandb.Artifact(
             name="pokedec_models",
@@ -226,31 +326,16 @@ def train_model(
             artifact.add_file(f"models/single/pokedec_model_{run.id}.pth")
         run.log_artifact(artifact)
 
-    # Export model to ONNX format
+    # Upload the ONNX model once the export has finished
     if export_model and use_wandb:
-        model.eval()
-        img, target = next(iter(val_loader))
-        img, target = img.to(DEVICE), target.to(DEVICE)
-
-        # Choose the first image in the batch
-        img = img[0].unsqueeze(0)
-
-        os.makedirs("models/onnx", exist_ok=True)
-        torch.onnx.export(
-            model,
-            img,
-            f"models/onnx/pokedec_model_{run.id}.onnx",
-            input_names=["input"],
-            output_names=["output"],
-            opset_version=11,
-        )
+        onnx_export.result()
 
         artifact = wandb.Artifact(
             name="pokedec_models_onnx",
             type="model",
             description="Model trained to classfiy Pokemon exported to ONNX format",
         )
-        artifact.add_file(f"models/onnx/pokedec_model_{run.id}.onnx")
+        artifact.add_file(onnx_path)
         run.log_artifact(artifact)
 
         wandb.finish()
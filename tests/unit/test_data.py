@@ -1,3 +1,4 @@
+import torch
 from torch.utils.data import Dataset
 
 from data import PokeData
@@ -7,3 +8,16 @@ def test_my_dataset():
     """Test the MyDataset class."""
     dataset = PokeData("data/raw")
     assert isinstance(dataset, Dataset)
+
+
+def test_input_shape(tmp_path):
+    """Test that the input shape is read from the preprocessed training data."""
+    (tmp_path / "processed").mkdir()
+    images = torch.zeros(4, 3, 64, 48)
+    labels = torch.zeros(4, dtype=torch.long)
+    torch.save({"images": images, "labels": labels}, tmp_path / "processed" / "train.pt")
+
+    poke_data = PokeData(tmp_path, batch_size=2, num_workers=0)
+    assert poke_data.input_shape is None
+    poke_data._get_train_loader()
+    assert poke_data.input_shape == (3, 64, 48)